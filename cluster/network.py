@@ -0,0 +1,217 @@
+"""Clustering on sparse correlation networks."""
+
+import numbers
+import pandas as pd
+import numpy as np
+import networkx as nx
+from scipy import sparse
+from scipy.sparse.csgraph import minimum_spanning_tree, connected_components
+from typing import Optional, Union
+
+def standardize_rows(X : np.ndarray) -> np.ndarray:
+    """
+    Parameters
+    ----------
+    - X: numpy.ndarray
+        An array whose rows are the time series (e.g. tickers x dates).
+
+    Returns
+    -------
+    - Z: numpy.ndarray
+        The rows of X centered and scaled so that Z @ Z.T is the correlation
+        matrix of the rows of X. Constant rows are mapped to zero, i.e. they
+        are uncorrelated with everything.
+    """
+    X = np.asarray(X, dtype=float)
+
+    if not np.isfinite(X).all():
+        raise ValueError("The input must not contain NaN or infinite values.")
+
+    Z = X - X.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(Z, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+
+    return Z / norms
+
+def sparse_correlation_graph(X : Union[pd.DataFrame, np.ndarray],
+                             n_neighbors : Optional[int] = 10,
+                             threshold : Optional[float] = None,
+                             block_size : int = 256) -> sparse.csr_matrix:
+    """
+    Builds a sparse, symmetric graph of the strongest correlations between the
+    rows of X. The correlations are computed `block_size` rows at a time, so
+    only a block_size x n slice of the correlation matrix is ever in memory.
+
+    Parameters
+    ----------
+    - X: pandas.DataFrame or numpy.ndarray
+        The data whose rows are the time series (e.g. `ClusterInput(df).df`).
+    - n_neighbors: int
+        The number of most correlated neighbours kept for every row.
+        If None, every pair above `threshold` is kept.
+    - threshold: float
+        The minimal correlation for an edge to be kept. If both `n_neighbors`
+        and `threshold` are given, only the k-nearest neighbours above the
+        threshold are kept.
+    - block_size: int
+        The number of rows whose correlations are computed at once.
+
+    Returns
+    -------
+    - graph: scipy.sparse.csr_matrix
+        An n x n symmetric matrix whose nonzero entries are the kept correlations.
+    """
+    if n_neighbors is None and threshold is None:
+        raise ValueError("At least one of `n_neighbors` and `threshold` must be specified.")
+    if not (isinstance(block_size, numbers.Integral) and block_size > 0):
+        raise ValueError("`block_size` must be a positive integer.")
+
+    Z = standardize_rows(X)
+    n = Z.shape[0]
+
+    if n_neighbors is not None:
+        if not (isinstance(n_neighbors, numbers.Integral) and n_neighbors > 0):
+            raise ValueError("`n_neighbors` must be a positive integer.")
+        n_neighbors = min(int(n_neighbors), n - 1)
+
+    # A single time series has no neighbours.
+    if n < 2:
+        return sparse.csr_matrix((n, n))
+
+    block_size = int(block_size)
+
+    rows, cols, vals = [], [], []
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = Z[start:stop] @ Z.T
+        block_rows = np.arange(start, stop)
+
+        # Exclude self-correlations.
+        block[block_rows - start, block_rows] = -np.inf
+
+        if n_neighbors is not None:
+            idx = np.argpartition(-block, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            r = np.repeat(block_rows, n_neighbors)
+            c = idx.ravel()
+            v = block[r - start, c]
+        else:
+            r_local, c = np.nonzero(block >= threshold)
+            r = block_rows[r_local]
+            v = block[r_local, c]
+
+        if threshold is not None:
+            mask = v >= threshold
+            r, c, v = r[mask], c[mask], v[mask]
+
+        rows.append(r)
+        cols.append(c)
+        vals.append(v)
+
+    rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+    cols = np.concatenate(cols) if cols else np.array([], dtype=int)
+    vals = np.concatenate(vals) if vals else np.array([], dtype=float)
+
+    # k-NN relations are not symmetric: keep an edge if either end selected it.
+    # This is done on the (row, col) pairs rather than on the values, so that
+    # negative or zero correlations are not lost against the implicit zeros.
+    rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+    vals = np.concatenate([vals, vals])
+    _, unique_idx = np.unique(rows * n + cols, return_index=True)
+
+    return sparse.csr_matrix(
+        (vals[unique_idx], (rows[unique_idx], cols[unique_idx])), shape=(n, n)
+        )
+
+class NetworkCluster:
+    """
+    Clusters time series by community detection on a sparse correlation network,
+    or by cutting the minimum spanning tree of that network.
+
+    Unlike the dense models, the full correlation matrix is never materialized.
+    With `n_neighbors` set, the graph has at most n * n_neighbors edges, so the
+    memory cost is O(n * n_neighbors) rather than O(n^2). With only `threshold`
+    set, the number of edges depends on the data and can grow to O(n^2).
+    """
+    def __init__(self,
+                 method : str = 'louvain',
+                 n_neighbors : Optional[int] = 10,
+                 threshold : Optional[float] = None,
+                 n_clusters : int = 11,
+                 resolution : float = 1.0,
+                 block_size : int = 256,
+                 random_state : Optional[int] = None
+                 ):
+        self.method = method
+        self.n_neighbors = n_neighbors
+        self.threshold = threshold
+        self.n_clusters = n_clusters
+        self.resolution = resolution
+        self.block_size = block_size
+        self.random_state = random_state
+
+    def _louvain_labels(self, graph):
+        # Only positive correlations make sense as modularity weights.
+        weights = graph.copy()
+        weights.data[weights.data <= 0] = 0
+        weights.eliminate_zeros()
+
+        G = nx.from_scipy_sparse_array(weights)
+        communities = nx.community.louvain_communities(
+            G, weight='weight', resolution=self.resolution, seed=self.random_state
+            )
+
+        labels = np.empty(graph.shape[0], dtype=int)
+        for (label, community) in enumerate(sorted(communities, key=len, reverse=True)):
+            labels[list(community)] = label
+
+        return labels
+
+    def _mst_labels(self, graph):
+        if not (isinstance(self.n_clusters, numbers.Integral) and self.n_clusters > 0):
+            raise ValueError("`n_clusters` must be a positive integer.")
+
+        # Correlation distance d = sqrt(2(1 - rho)); a small offset keeps
+        # perfectly correlated pairs from being dropped as zero entries.
+        distances = graph.copy()
+        distances.data = np.sqrt(np.clip(2 * (1 - distances.data), 0, None)) + 1e-12
+
+        tree = minimum_spanning_tree(distances).tocoo()
+
+        # Cutting the heaviest edges of the tree (forest) leaves n_clusters components.
+        n_components = connected_components(tree, directed=False)[0]
+        n_cuts = max(min(self.n_clusters - n_components, tree.nnz), 0)
+        keep = np.argsort(tree.data)[:tree.nnz - n_cuts]
+
+        self.tree_ = sparse.csr_matrix(
+            (tree.data[keep], (tree.row[keep], tree.col[keep])), shape=tree.shape
+            )
+
+        return connected_components(self.tree_, directed=False)[1]
+
+    def fit(self, df):
+        """
+        Parameters
+        ----------
+        - df: pandas.DataFrame or numpy.ndarray
+            The data whose rows are the tickers and whose columns are the dates,
+            as produced by `ClusterInput(df).df`.
+
+        Returns
+        -------
+            The fitted instance, with the cluster labels stored in `labels_` and
+            the sparse correlation network in `graph_`.
+        """
+        if self.method not in ('louvain', 'mst'):
+            raise ValueError("The method must be either `louvain` or `mst`.")
+
+        self.graph_ = sparse_correlation_graph(
+            df, n_neighbors=self.n_neighbors, threshold=self.threshold, block_size=self.block_size
+            )
+
+        if self.method == 'louvain':
+            self.labels_ = self._louvain_labels(self.graph_)
+        else:
+            self.labels_ = self._mst_labels(self.graph_)
+
+        return self
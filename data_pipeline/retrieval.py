@@ -139,9 +139,10 @@ def download_historical_data(tickers : List[str] = DataBank().get_tickers(),
     except Exception as e:
         print(f"{e}: Failed to load saved data. Loading data...")
 
+    # yfinance expects an explicit interval, and only keeps the `Adj Close` column when auto_adjust=False.
     historical_data = yf.download(
-        tickers=tickers, start=start, end=end, interval=interval
-    ).dropna(axis=1, inplace=True)
+        tickers=tickers, start=start, end=end, interval='1d' if interval is None else interval, auto_adjust=False
+    ).dropna(axis=1)
 
     if save_data:
         historical_data.to_pickle(data_path)
@@ -188,7 +189,7 @@ def download_adj_close(tickers : List[str] = DataBank().get_tickers(),
     
     adj_closing_prices = download_historical_data(
             tickers=tickers, start=start, end=end, interval=interval, save_data=False
-            )['Adj Close'].dropna(axis=1, inplace=True)
+            )['Adj Close'].dropna(axis=1)
 
     if save_data:
         adj_closing_prices.to_pickle(data_path)
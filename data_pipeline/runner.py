@@ -0,0 +1,463 @@
+"""
+Checkpointed batch runner for the retrieval -> transform -> cluster -> score pipeline.
+
+The stages are arranged in a dependency graph. Every stage is keyed by a hash of
+its function's source, the source of the modules it declares as code dependencies,
+its parameters, the contents of any input files and the hashes of its upstream
+outputs. Outputs are pickled under `cache_dir`, so a stage whose key has not
+changed is skipped, and a stage whose upstream outputs are byte-for-byte identical
+to the previous run is skipped as well. Independent branches (e.g. several models
+or windows) are run in parallel. If a stage fails, its descendants are skipped,
+the other branches still run and are checkpointed, and the run exits with a
+non-zero status once the timing report has been written.
+
+What is tracked: the stage function itself, and the whole defining module of every
+declared code dependency (for the default stages: `data_pipeline.retrieval` and
+`data_pipeline.processing`, the configured model class and the score function),
+together with the version of its top-level package. What is not tracked: modules
+that those modules import in turn, and data fetched over the network (the
+`retrieve` stage is keyed by its dates, so a fixed window is downloaded once).
+Use `--force` after changing untracked code.
+
+Usage
+-----
+    python -m data_pipeline.runner config.json --workers 4
+
+where `config.json` looks like
+
+    {
+        "cache_dir": "./data/checkpoints",
+        "data": {"start": "2021-11-30", "end": "2023-11-30", "interval": null},
+        "windows": {"2022": {"start": "2022-01-01", "end": "2022-12-31"},
+                    "2023": {"start": "2023-01-01", "end": "2023-11-30"}},
+        "models": {"kmeans": {"class": "sklearn.cluster.KMeans", "params": {"n_clusters": 11}},
+                   "network": {"class": "cluster.network.NetworkCluster", "params": {}}},
+        "score": "sklearn.metrics.silhouette_score"
+    }
+
+Instead of "start"/"end", "data" may contain a "load_path" to a pickled dataframe
+of adjusted closing prices. "windows" is optional and defaults to the full range.
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import hashlib
+import inspect
+import argparse
+import importlib
+import importlib.util
+import tempfile
+import traceback
+import pandas as pd
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, List, Optional
+
+def _digest(data : bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def _file_digest(path : str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda : f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _callable_digest(func : Callable) -> str:
+    """Hashes the source of `func` (falling back on its name), so code changes invalidate checkpoints."""
+    while isinstance(func, partial):
+        func = func.func
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+    return _digest(source.encode())
+
+def _code_digest(path : str) -> str:
+    """
+    Hashes the source of the module `path`, or of the module defining the object
+    at the dotted path `path`, together with the version of its top-level package.
+    Modules are read without being imported where possible.
+    """
+    try:
+        spec = importlib.util.find_spec(path)
+    except (ImportError, ValueError):
+        spec = None
+
+    if spec is not None and spec.origin is not None and os.path.isfile(spec.origin):
+        with open(spec.origin, 'rb') as f:
+            source = f.read()
+    else:
+        module = inspect.getmodule(import_from_path(path))
+        try:
+            source = inspect.getsource(module).encode()
+        except (OSError, TypeError):
+            source = module.__name__.encode()
+
+    top_level = importlib.import_module(path.partition('.')[0])
+    version = str(getattr(top_level, '__version__', ''))
+
+    return _digest(source + version.encode())
+
+def import_from_path(path : str):
+    """Imports an object given its dotted path, e.g. `sklearn.cluster.KMeans`."""
+    module_name, _, attr = path.rpartition('.')
+    if not module_name:
+        raise ValueError(f"`{path}` is not a dotted path of the form `module.attribute`.")
+    return getattr(importlib.import_module(module_name), attr)
+
+class Stage:
+    def __init__(self,
+                 name : str,
+                 func : Callable,
+                 deps : Optional[List[str]] = None,
+                 params : Optional[Dict[str, Any]] = None,
+                 files : Optional[List[str]] = None,
+                 code : Optional[List[str]] = None):
+        """
+        Parameters
+        ----------
+        - name: str
+            The unique name of the stage.
+        - func: Callable
+            The function to be run. It is called as func(*upstream_outputs, **params),
+            with the upstream outputs in the order of `deps`.
+        - deps: List[str]
+            The names of the stages whose outputs are the inputs of this stage.
+        - params: Dict[str, Any]
+            Additional keyword arguments. These must be JSON serializable (or have a
+            stable `repr`), since they are part of the checkpoint key.
+        - files: List[str]
+            Paths of files read by `func`. Their contents are part of the checkpoint key.
+        - code: List[str]
+            Dotted paths of the modules (or objects, e.g. `sklearn.cluster.KMeans`) that
+            `func` relies on. The source of each (defining) module is part of the
+            checkpoint key, so editing it invalidates the checkpoints of this stage.
+        """
+        self.name = name
+        self.func = func
+        self.deps = list(deps) if deps is not None else []
+        self.params = dict(params) if params is not None else {}
+        self.files = list(files) if files is not None else []
+        self.code = list(code) if code is not None else []
+
+    def key(self, upstream_hashes : List[str]) -> str:
+        payload = json.dumps({
+            'name' : self.name,
+            'func' : _callable_digest(self.func),
+            'params' : self.params,
+            'files' : [_file_digest(path) for path in self.files],
+            'code' : [_code_digest(path) for path in self.code],
+            'upstream' : upstream_hashes
+            }, sort_keys=True, default=repr)
+
+        return _digest(payload.encode())
+
+def _atomic_write(path : str, data : bytes) -> None:
+    """Writes `data` to a temporary file next to `path` and moves it into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _run_stage(func, inputs, params):
+    start = time.perf_counter()
+    output = func(*inputs, **params)
+    return output, time.perf_counter() - start
+
+class Pipeline:
+    def __init__(self, stages : List[Stage], cache_dir : str = './data/checkpoints'):
+        names = [stage.name for stage in stages]
+        if len(set(names)) != len(names):
+            raise ValueError("The stage names must be unique.")
+
+        self.stages = {stage.name : stage for stage in stages}
+        self.cache_dir = cache_dir
+
+        for stage in stages:
+            missing = [dep for dep in stage.deps if dep not in self.stages]
+            if missing:
+                raise ValueError(f"Stage `{stage.name}` depends on unknown stage(s) {missing}.")
+
+        self.order = self.topological_order()
+
+    def topological_order(self) -> List[str]:
+        indegree = {name : len(stage.deps) for (name, stage) in self.stages.items()}
+        children = {name : [] for name in self.stages}
+        for stage in self.stages.values():
+            for dep in stage.deps:
+                children[dep].append(stage.name)
+
+        ready = [name for (name, deg) in indegree.items() if deg == 0]
+        order = []
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for child in children[name]:
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    ready.append(child)
+
+        if len(order) != len(self.stages):
+            raise ValueError("The stages contain a dependency cycle.")
+
+        return order
+
+    def _paths(self, name : str, key : str):
+        stage_dir = os.path.join(self.cache_dir, name)
+        return os.path.join(stage_dir, f'{key}.pkl'), os.path.join(stage_dir, f'{key}.json')
+
+    def _save(self, name : str, key : str, output) -> str:
+        output_path, meta_path = self._paths(name, key)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        data = pickle.dumps(output)
+        output_hash = _digest(data)
+
+        # Write the metadata last: its presence marks the checkpoint as complete.
+        _atomic_write(output_path, data)
+        _atomic_write(meta_path, json.dumps({'output_hash' : output_hash}).encode())
+
+        return output_hash
+
+    def _load_meta(self, name : str, key : str) -> Optional[dict]:
+        output_path, meta_path = self._paths(name, key)
+        if not (os.path.exists(output_path) and os.path.exists(meta_path)):
+            return None
+
+        # An unreadable checkpoint is treated as missing, so the stage is simply rerun.
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        return meta if isinstance(meta, dict) and 'output_hash' in meta else None
+
+    def load_output(self, name : str, key : str):
+        output_path, _ = self._paths(name, key)
+        with open(output_path, 'rb') as f:
+            return pickle.load(f)
+
+    def run(self, max_workers : int = 1, processes : bool = False, force : bool = False) -> Dict[str, dict]:
+        """
+        Parameters
+        ----------
+        - max_workers: int
+            The maximal number of stages to be run at once.
+        - processes: bool
+            Whether to run stages in separate processes rather than threads. The stage
+            functions, parameters and outputs must then be picklable.
+        - force: bool
+            Whether to ignore existing checkpoints and rerun every stage.
+
+        Returns
+        -------
+        - report: Dict[str, dict]
+            For every stage: its checkpoint key, its status and the time (in seconds)
+            it took. The status is `ran` or `cached` on success, `failed` if the stage
+            raised (the traceback is stored under `error`), or `skipped` if one of its
+            upstream stages did not succeed. Failures do not stop independent branches.
+        """
+        Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+
+        keys, output_hashes, outputs, report = {}, {}, {}, {}
+        unsuccessful = set()
+        pending = list(self.order)
+        running = {}
+
+        def inputs_of(stage):
+            for dep in stage.deps:
+                if dep not in outputs:
+                    outputs[dep] = self.load_output(dep, keys[dep])
+            return [outputs[dep] for dep in stage.deps]
+
+        def mark_failed(name, seconds, error):
+            unsuccessful.add(name)
+            report[name] = {'key' : keys.get(name), 'status' : 'failed', 'seconds' : seconds, 'error' : error}
+            print(f"[failed] {name}: {error.strip().splitlines()[-1]}")
+
+        with Executor(max_workers=max_workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    stage = self.stages[name]
+
+                    failed_deps = [dep for dep in stage.deps if dep in unsuccessful]
+                    if failed_deps:
+                        pending.remove(name)
+                        unsuccessful.add(name)
+                        report[name] = {'key' : None, 'status' : 'skipped', 'seconds' : 0.0,
+                                        'error' : f"Upstream stage(s) {failed_deps} did not succeed."}
+                        print(f"[skipped] {name}")
+                        continue
+
+                    if not all(dep in output_hashes for dep in stage.deps):
+                        continue
+                    pending.remove(name)
+
+                    start = time.perf_counter()
+                    try:
+                        keys[name] = stage.key([output_hashes[dep] for dep in stage.deps])
+                        meta = None if force else self._load_meta(name, keys[name])
+
+                        if meta is not None:
+                            output_hashes[name] = meta['output_hash']
+                            report[name] = {'key' : keys[name], 'status' : 'cached',
+                                            'seconds' : time.perf_counter() - start}
+                            print(f"[cached] {name}")
+                        else:
+                            future = executor.submit(_run_stage, stage.func, inputs_of(stage), stage.params)
+                            running[future] = (name, start)
+                    except Exception:
+                        mark_failed(name, time.perf_counter() - start, traceback.format_exc())
+
+                if not running:
+                    # Cached stages may have unblocked others; rescan before waiting.
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, start = running.pop(future)
+                    try:
+                        output, seconds = future.result()
+                        output_hashes[name] = self._save(name, keys[name], output)
+                    except Exception:
+                        mark_failed(name, time.perf_counter() - start, traceback.format_exc())
+                        continue
+
+                    outputs[name] = output
+                    report[name] = {'key' : keys[name], 'status' : 'ran', 'seconds' : seconds}
+                    print(f"[ran] {name} ({seconds:.2f}s)")
+
+        self.outputs_ = outputs
+        self.keys_ = keys
+
+        return report
+
+def load_adj_close(load_path : str):
+    from data_pipeline.retrieval import load
+    return load(load_path)
+
+def retrieve_adj_close(start : str, end : str, interval : Optional[str] = None):
+    # Imported here since `data_pipeline.retrieval` fetches the ticker table on import.
+    from data_pipeline.retrieval import download_adj_close
+    return download_adj_close(start=start, end=end, interval=interval, save_data=False)
+
+def _parse_date(date : Optional[str]) -> Optional[pd.Timestamp]:
+    if date is None:
+        return None
+    try:
+        return pd.Timestamp(date)
+    except (ValueError, TypeError):
+        raise ValueError(f"`{date}` is not a valid date. Please use the 'YYYY-MM-DD' format.")
+
+def transform_window(df, start : Optional[str] = None, end : Optional[str] = None):
+    from data_pipeline.processing import ClusterInput
+
+    # Saved price data may come with an object-dtype index, which cannot be sliced by date.
+    df = df.copy()
+    df.index = pd.DatetimeIndex(pd.to_datetime(df.index), name=df.index.name)
+
+    return ClusterInput(df.loc[_parse_date(start):_parse_date(end)]).df
+
+def fit_labels(data, model : str, params : Optional[Dict[str, Any]] = None):
+    ClusteringModel = import_from_path(model)
+    return ClusteringModel(**(params or {})).fit(data).labels_
+
+def score_labels(data, labels, score : str):
+    return import_from_path(score)(data, labels)
+
+def build_stages(config : dict) -> List[Stage]:
+    """
+    Builds the stages of the pipeline from a configuration dictionary. (See the
+    module docstring for the expected format.)
+    """
+    data_config = config.get('data', {})
+    if 'load_path' in data_config:
+        stages = [Stage('retrieve', load_adj_close,
+                        params={'load_path' : data_config['load_path']},
+                        files=[data_config['load_path']],
+                        code=['data_pipeline.retrieval'])]
+    else:
+        stages = [Stage('retrieve', retrieve_adj_close,
+                        params={'start' : data_config['start'],
+                                'end' : data_config['end'],
+                                'interval' : data_config.get('interval')},
+                        code=['data_pipeline.retrieval'])]
+
+    windows = config.get('windows') or {'all' : {}}
+    models = config.get('models', {})
+    score = config.get('score')
+
+    for (window_name, window) in windows.items():
+        transform_name = f'transform_{window_name}'
+        stages.append(Stage(transform_name, transform_window, deps=['retrieve'],
+                            params={'start' : window.get('start'), 'end' : window.get('end')},
+                            code=['data_pipeline.processing', 'data_pipeline.retrieval']))
+
+        for (model_name, model) in models.items():
+            fit_name = f'fit_{window_name}_{model_name}'
+            stages.append(Stage(fit_name, fit_labels, deps=[transform_name],
+                                params={'model' : model['class'], 'params' : model.get('params', {})},
+                                code=[model['class']]))
+
+            if score is not None:
+                stages.append(Stage(f'score_{window_name}_{model_name}', score_labels,
+                                    deps=[transform_name, fit_name], params={'score' : score},
+                                    code=[score]))
+
+    return stages
+
+def main(argv : Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Run the clustering pipeline with checkpointed stages.")
+    parser.add_argument('config', help="Path to the JSON configuration file.")
+    parser.add_argument('--workers', type=int, default=1, help="Maximal number of stages run at once.")
+    parser.add_argument('--processes', action='store_true', help="Run stages in processes rather than threads.")
+    parser.add_argument('--force', action='store_true', help="Ignore existing checkpoints.")
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    cache_dir = config.get('cache_dir', './data/checkpoints')
+    pipeline = Pipeline(build_stages(config), cache_dir=cache_dir)
+
+    start = time.perf_counter()
+    report = pipeline.run(max_workers=args.workers, processes=args.processes, force=args.force)
+    total = time.perf_counter() - start
+
+    report_dir = os.path.join(cache_dir, 'reports')
+    os.makedirs(report_dir, exist_ok=True)
+    # The random suffix keeps runs finishing within the same second from overwriting each other.
+    fd, report_path = tempfile.mkstemp(prefix=f"{time.strftime('%Y-%m-%d_%H-%M-%S')}_", suffix='.json', dir=report_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'total_seconds' : total, 'stages' : report}, f, indent=2)
+
+    for name in pipeline.order:
+        if not name.startswith('score_') or report[name]['status'] not in ('ran', 'cached'):
+            continue
+        if name in pipeline.outputs_:
+            print(f"{name}: {pipeline.outputs_[name]}")
+        else:
+            print(f"{name}: {pipeline.load_output(name, pipeline.keys_[name])}")
+
+    unsuccessful = [name for (name, entry) in report.items() if entry['status'] in ('failed', 'skipped')]
+
+    print(f"Finished in {total:.2f}s. Timings written to {report_path}.")
+
+    if unsuccessful:
+        print(f"{len(unsuccessful)} stage(s) did not succeed: {unsuccessful}")
+        sys.exit(1)
+
+    return report
+
+if __name__ == '__main__':
+    main()